@@ -1,3 +1,5 @@
+from functools import lru_cache
+
 import django
 from django.db import connections
 from django.db.models import Expression, F, QuerySet, Value, Window
@@ -13,6 +15,19 @@ def _find_tree_model(cls):
     return cls._meta.get_field("parent").model
 
 
+@lru_cache(maxsize=128)
+def _format_cte(cte, params):
+    """
+    Returns the parts of the CTE before and after the rank table
+
+    The formatted CTE only depends on the database vendor, the model and the
+    tree fields, so it is cached. The rank table is spliced in afterwards.
+    """
+    head, tail = cte.split("{rank_table}")
+    params = dict(params)
+    return head.format(**params), tail.format(**params)
+
+
 class TreeQuery(Query):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -42,6 +57,13 @@ class TreeQuery(Query):
         if not hasattr(self, "tree_fields"):
             self.tree_fields = {}
 
+        # Clones share this single-slot cache of the compiled rank table. The
+        # entry records what it was compiled from so that changes in a clone
+        # are detected. Clones with different rank tables overwrite each
+        # other's entry; alternating between them recompiles every time.
+        if not hasattr(self, "rank_table_cache"):
+            self.rank_table_cache = [None]
+
     def get_compiler(self, using=None, connection=None, **kwargs):
         # Copied from django/db/models/sql/query.py
         if using is None and connection is None:
@@ -71,7 +93,7 @@ class TreeCompiler(SQLCompiler):
         "{pk}",
         "{parent}",
         "rank_order"
-    ) AS (
+    ) AS {materialized}(
         {rank_table}
     ),
     __tree (
@@ -182,6 +204,23 @@ class TreeCompiler(SQLCompiler):
     """
 
     def get_rank_table(self):
+        # Compiling the rank table queryset is the most expensive part of
+        # as_sql(), and the same query is often compiled several times, e.g.
+        # for .count() and the actual results when paginating.
+        key = (
+            self.query.get_sibling_order(),
+            self.query.get_rank_table_query(),
+            dict(self.query.get_tree_fields()),
+        )
+        cached = self.query.rank_table_cache[0]
+        if cached and cached[0] == key:
+            return cached[1]
+
+        rank_table = self._compile_rank_table()
+        self.query.rank_table_cache[0] = (key, rank_table)
+        return rank_table
+
+    def _compile_rank_table(self):
         # Get and validate sibling_order
         sibling_order = self.query.get_sibling_order()
 
@@ -275,10 +314,15 @@ class TreeCompiler(SQLCompiler):
 
         # Get the rank_table SQL and params
         rank_table_sql, rank_table_params = self.get_rank_table()
-        params["rank_table"] = rank_table_sql
 
         if self.connection.vendor == "postgresql":
             cte = self.CTE_POSTGRESQL
+            # The rank table is referenced twice in the recursive CTE, so
+            # PostgreSQL materializes it anyway; the keyword only makes this
+            # explicit. Versions older than 12 do not know the keyword.
+            params["materialized"] = (
+                "MATERIALIZED " if self.connection.pg_version >= 120000 else ""
+            )
             cte_initial = "array[T.{column}]::text[], "
             cte_recursive = "__tree.{name} || T.{column}::text, "
         elif self.connection.vendor == "sqlite":
@@ -344,15 +388,31 @@ class TreeCompiler(SQLCompiler):
                 ),
             )
 
+        cte_head, cte_tail = _format_cte(cte, tuple(sorted(params.items())))
+
         sql_0, sql_1 = super().as_sql(*args, **kwargs)
         explain = ""
         if sql_0.startswith("EXPLAIN "):
-            explain, sql_0 = sql_0.split(" ", 1)
+            # The prefix may consist of several words, e.g. EXPLAIN QUERY PLAN
+            # on sqlite3 or EXPLAIN (FORMAT JSON, COSTS false) on PostgreSQL.
+            # The CTE has to follow all of them.
+            if explain_info := getattr(self.query, "explain_info", None):
+                explain = self.connection.ops.explain_query_prefix(
+                    explain_info.format, **explain_info.options
+                )
+            else:  # pragma: no cover - Django < 4.0
+                explain = self.connection.ops.explain_query_prefix(
+                    self.query.explain_format, **self.query.explain_options
+                )
+            if sql_0.startswith(explain):
+                sql_0 = sql_0[len(explain) :]
+            else:  # pragma: no cover - unexpected prefix
+                explain, sql_0 = sql_0.split(" ", 1)
 
         # Pass any additional rank table sql paramaters so that the db backend can handle them.
         # This only works because we know that the CTE is at the start of the query.
         return (
-            "".join([explain, cte.format(**params), sql_0]),
+            "".join([explain, cte_head, rank_table_sql, cte_tail, sql_0]),
             rank_table_params + sql_1,
         )
 
@@ -381,6 +441,6 @@ def converter(value, expression, connection, context=None):
 
     try:
         # Either all values are convertible to int or don't bother
-        return [int(v) for v in value]  # Maybe Field.to_python()?
+        return list(map(int, value))  # Maybe Field.to_python()?
     except ValueError:
         return value
@@ -125,11 +125,10 @@ class TreeQuerySet(models.QuerySet):
         else:
             queryset = self.with_tree_fields().extra(
                 # NOTE! The representation of tree_path is NOT part of the API.
-                where=[
-                    # XXX This *may* be unsafe with some primary key field types.
-                    # It is certainly safe with integers.
-                    f'instr(__tree.tree_path, "{SEPARATOR}{self.model._meta.pk.get_db_prep_value(pk(of), connection)}{SEPARATOR}") <> 0'
-                ]
+                where=["instr(__tree.tree_path, %s) <> 0"],
+                params=[
+                    f"{SEPARATOR}{self.model._meta.pk.get_db_prep_value(pk(of), connection)}{SEPARATOR}"
+                ],
             )
 
         if not include_self: